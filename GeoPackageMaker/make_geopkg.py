@@ -5,13 +5,24 @@ import glob
 import os
 import sys
 import argparse
-from zipfile import ZipFile
-
-import pandas as pd
+import logging
+import sqlite3
+import struct
+from contextlib import closing
+from itertools import islice
+from zipfile import ZipFile, ZIP_DEFLATED
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
 
 # For Accessing AWS S3 buckets
 import boto3
 import botocore
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import BotoCoreError, ClientError
 
 from pygeopkg.core.geopkg import GeoPackage
@@ -20,8 +31,7 @@ from pygeopkg.core.field import Field
 from pygeopkg.shared.enumeration import GeometryType, SQLFieldTypes
 from random import choice, randint
 from string import ascii_uppercase, digits
-from pygeopkg.conversion.to_geopkg_geom import (
-    point_to_gpkg_point, make_gpkg_geom_header)
+from pygeopkg.conversion.to_geopkg_geom import make_gpkg_geom_header
 from pygeopkg.shared.constants import SHAPE
 
 
@@ -29,7 +39,9 @@ from pygeopkg.shared.constants import SHAPE
 # There are lots of things TODO:
 # - Replace 'pygeopkg; with 'fudgeo' or an alternative is 'fiona'
 # - Make fields easy to change
-# - Use geopandas instead of features.csv file
+
+# Per-file and per-row progress messages, only shown with '--verbose'
+LOGGER = logging.getLogger(__name__)
 
 # Local directory where borehole input files are kept
 DATA_DIR = "data"
@@ -40,119 +52,296 @@ BUCKET_NAME = "bucket"
 BUCKET_REGION = "ap-southeast-2"
 BUCKET_DIR = f"https://{BUCKET_NAME}.s3.{BUCKET_REGION}.amazonaws.com/{BUCKET_FOLDER}/"
 
-
-# Columns in our internal dataframe
+# Number of zip files uploaded to AWS s3 at the same time
+UPLOAD_WORKERS = 16
+# Each upload is also split into parts which are sent in parallel
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8*1024*1024, multipart_chunksize=8*1024*1024, max_concurrency=10, use_threads=True)
+# A single s3 client is shared by all upload workers
+# Its connection pool (default 10) must be big enough for all the workers to send all of their parts at once
+# Failed requests are retried with exponential backoff
+S3_CONFIG = Config(max_pool_connections=UPLOAD_WORKERS*TRANSFER_CONFIG.max_concurrency, retries={'max_attempts': 5, 'mode': 'adaptive'}, tcp_keepalive=True)
+# Zip files larger than this are spooled to a temporary file instead of memory
+ZIP_SPOOL_SIZE = 64*1024*1024
+
+# WKB point: little endian byte order marker, geometry type (1 = point), x, y
+WKB_POINT = struct.Struct('<BIdd')
+
+# Columns in our internal datasets table
 DS_COLS = ["borehole_header_id", "depth", "depth_point", "diameter", "p_wave_amplitude", "p_wave_velocity", "density", "magnetic_susceptibility", "impedance", "natural_gamma", "resistivity"]
 
-# Maps from input CSV datafile to our internal dataframe
+# Column types in our internal datasets table, the same for every CSV file so that they can be concatenated
+# Apart from 'depth', these are text fields in the geopackage so are kept as the text in the CSV file
+DS_SCHEMA = pa.schema([("borehole_header_id", pa.int32()), ("depth", pa.float64())] + [(col_name, pa.string()) for col_name in DS_COLS[2:]])
+
+# A 'depth' value which can be converted to float, once spaces are trimmed
+DEPTH_REGEX = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+# Maps from input CSV datafile to our internal datasets table
 # Some columns in the input files have two possible names
 COL_MAP = {"depth": ["DEPTH"], "depth_point":["DEPTH"], "diameter": ["DIAMETER"],
 "p_wave_amplitude": ["P-WAVE AMP.", "P-WAVE AMPLITUDE"], "p_wave_velocity": ["P-WAVE VEL.", "P-WAVE VELOCITY"],
 "density": ["DENSITY"], "magnetic_susceptibility": ["MAG. SUS", "MAG. SUSC."],
 "impedance":["IMPEDANCE"], "natural_gamma":["N. GAMMA", "NAT. GAMMA"], "resistivity":["RESISTIVITY"]}
 
+# Spatial reference system for all geopackage tables
+SRS_WKT = (
+    'GEOGCS["WGS 84",'
+    'DATUM["WGS_1984",'
+        'SPHEROID["WGS 84",6378137,298.257223563,'
+            'AUTHORITY["EPSG","7030"]],'
+        'AUTHORITY["EPSG","6326"]],'
+    'PRIMEM["Greenwich",0,'
+        'AUTHORITY["EPSG","8901"]],'
+    'UNIT["degree",0.0174532925199433,'
+        'AUTHORITY["EPSG","9122"]],'
+    'AUTHORITY["EPSG","4326"]]')
+
+WGS84_SRS = SRS('WGS84', 'EPSG', 4326, SRS_WKT)
+
+# Fields in geopackage 'boreholes' table
+# "identifier", "borehole_id", "name","boreholeMaterialCustodian","description","drillStartDate","drillEndDate","easting","northing","elevation_m","boreholeLength_m","long","lat","nvclCollection","drillingMethod","driller","startPoint","inclinationType","elevation_srs","operator"
+BOREHOLE_FIELDS = (
+    Field('identifier', SQLFieldTypes.integer),  # Integer incremented from 1 matches with an id in the data
+    Field('borehole_id', SQLFieldTypes.integer),  # Borehole identifier. NB: this is not unique
+    Field('name', SQLFieldTypes.text),
+    Field('datasetProperties', SQLFieldTypes.text),
+    Field('boreholeMaterialCustodian', SQLFieldTypes.text),
+    Field('description', SQLFieldTypes.text),
+    Field('drillStartDate', SQLFieldTypes.text),
+    Field('drillEndDate', SQLFieldTypes.text),
+    Field('elevation_m', SQLFieldTypes.float),
+    Field('boreholeLength_m', SQLFieldTypes.float),
+    Field('long', SQLFieldTypes.float),
+    Field('lat', SQLFieldTypes.float),
+    Field('nvclCollection', SQLFieldTypes.text),
+    Field('drillingMethod', SQLFieldTypes.text),
+    Field('driller', SQLFieldTypes.text),
+    Field('startPoint', SQLFieldTypes.text),
+    Field('inclinationType', SQLFieldTypes.text),
+    Field('elevation_srs', SQLFieldTypes.text),
+    Field('operator', SQLFieldTypes.text),
+    Field('datasetURL', SQLFieldTypes.text)
+)
+# Field names used to insert rows, the geometry comes first
+BOREHOLE_FIELD_NAMES = [SHAPE, "identifier","borehole_id", "name", "datasetProperties", "boreholeMaterialCustodian","description","drillStartDate","drillEndDate","elevation_m","boreholeLength_m","long","lat","nvclCollection","drillingMethod","driller","startPoint","inclinationType","elevation_srs","operator", "datasetURL"]
+
+# Fields in geopackage 'datasets' table
+DATASET_FIELDS = (
+    Field('borehole_header_id', SQLFieldTypes.integer), # this matches up with 'identifier'
+    Field('borehole_id', SQLFieldTypes.integer),
+    Field('depth', SQLFieldTypes.float),
+    Field('depth_point', SQLFieldTypes.text),
+    Field('diameter', SQLFieldTypes.text),
+    Field('p_wave_amplitude', SQLFieldTypes.text),
+    Field('p_wave_velocity', SQLFieldTypes.text),
+    Field('density', SQLFieldTypes.text),
+    Field('magnetic_susceptibility', SQLFieldTypes.text),
+    Field('impedance', SQLFieldTypes.text),
+    Field('natural_gamma', SQLFieldTypes.text),
+    Field('resistivity', SQLFieldTypes.text)
+    )
+# Field names used to insert rows, the geometry comes first
+DATASET_FIELD_NAMES = [SHAPE, "borehole_header_id","depth","depth_point","diameter","p_wave_amplitude","p_wave_velocity","density","magnetic_susceptibility","impedance","natural_gamma","resistivity"]
+
+# Generate the geometry header once because it is always the same
+POINT_GEOM_HDR = make_gpkg_geom_header(WGS84_SRS.srs_id)
+
+
+def find_data_header(csv_file: str):
+    ''' Peeks at the first few rows of an input CSV file to find the data header, which is in the 3rd or 4th row
+
+    :param csv_file: full path in local filesystem of CSV file
+    :returns: number of lines before the data header and list of its column names, or (None, None) if it cannot be found
+    '''
+    with open(csv_file, newline='') as datafile:
+        csvreader = csv.reader(datafile, delimiter=',')
+        # NB: Quoted metadata values can have newlines in them, so count the lines which pyarrow skips, not the rows
+        skip_lines = 0
+        for hdr_idx, row in enumerate(islice(csvreader, 5)):
+            # A blank first column name means this is not the data header
+            if hdr_idx in (3, 4) and row and row[0] != '':
+                return skip_lines, row
+            skip_lines = csvreader.line_num
+    return None, None
+
+
+def parse_depth(csv_file: str, depth: pa.ChunkedArray) -> pa.ChunkedArray:
+    ''' Converts a 'depth' text column to float, values which are not numbers are left empty with a warning
+
+    :param csv_file: full path in local filesystem of CSV file
+    :param depth: 'depth' column read as text
+    :returns: 'depth' column of floats
+    '''
+    # Like pandas, allow spaces around the numbers
+    depth = pc.utf8_trim_whitespace(depth)
+    is_number = pc.match_substring_regex(depth, DEPTH_REGEX)
+    not_numbers = pc.sum(pc.invert(is_number)).as_py()
+    if not_numbers:
+        print(f"{not_numbers} 'depth' values in {csv_file} are not numbers, they are left empty")
+        depth = pc.if_else(is_number, depth, pa.scalar(None, pa.string()))
+    return pc.cast(depth, pa.float64())
+
+
+def read_dataset(file_idx: int, csv_file: str):
+    ''' Reads the datasets from one CSV file into a pyarrow table
+    Runs in a worker process, so must only depend on its arguments
+    NB: Logging is not set up in worker processes on all platforms, so progress is logged by 'make_datasets()'
+
+    :param file_idx: index of CSV file, used to make the 'borehole_header_id'
+    :param csv_file: full path in local filesystem of CSV file
+    :returns: CSV filename, pyarrow table of datasets, list of dataset property col names
+    '''
+    # Process a CSV file
+    skip_lines, src_names = find_data_header(csv_file)
+    if skip_lines is None:
+        print(f"Cannot find data header in {csv_file}")
+        sys.exit(1)
+    # Source column for each of our columns, excluding 'borehole_header_id'
+    # Looking to columns in input file - try one of the options else fail
+    src_name_set = set(src_names)
+    src_cols = [next((src for src in COL_MAP[col_name] if src in src_name_set), None) for col_name in DS_COLS[1:]]
+    if None in src_cols:
+        print(f"{COL_MAP[DS_COLS[1 + src_cols.index(None)]]} is missing from {csv_file}")
+        print("src_ds=", src_names)
+        sys.exit(1)
+
+    # Rows with a different number of columns to the header are skipped with a warning, pandas would pad them
+    skipped_rows = []
+    def skip_row(row):
+        skipped_rows.append(row)
+        return 'skip'
+
+    # Read csv file once, parsing only the source columns
+    # Empty cells are null in text columns too, as they are in pandas
+    # NB: No pyarrow threads, the files are already being read in parallel
+    try:
+        src_tbl = pacsv.read_csv(csv_file, read_options=pacsv.ReadOptions(skip_rows=skip_lines, use_threads=False),
+                                 parse_options=pacsv.ParseOptions(delimiter=',', invalid_row_handler=skip_row),
+                                 convert_options=pacsv.ConvertOptions(include_columns=list(dict.fromkeys(src_cols)),
+                                                                      column_types={src: pa.string() for src in src_cols},
+                                                                      strings_can_be_null=True))
+    except (pa.ArrowInvalid, pa.ArrowKeyError) as ai:
+        print(f"Cannot read data in {csv_file}: {ai}")
+        sys.exit(1)
+    for row in skipped_rows:
+        print(f"Skipping row in {csv_file}, expected {row.expected_columns} columns, got {row.actual_columns}: {row.text}")
+
+    ds_tbl = src_tbl.select(src_cols).rename_columns(DS_COLS[1:])
+    # First column: 'borehole_header_id' links with the bh dataset
+    # Second column: 'depth'
+    # Third and subsequent columns:  row[:11] = 'depth_point', 'diameter' etc.
+    ds_tbl = ds_tbl.add_column(0, 'borehole_header_id', pa.array([file_idx + 1] * ds_tbl.num_rows, type=pa.int32()))
+    ds_tbl = ds_tbl.set_column(1, 'depth', parse_depth(csv_file, ds_tbl.column('depth')))
+
+    # Dataset property list, only add a column to list if it is not all null
+    # NB: pyarrow counts nulls as it reads each column, so no pass over the data is needed here.
+    #     Columns are read as text with 'strings_can_be_null', so empty, 'NaN', 'nan' etc. values are null
+    ds_prop_list = [col_name for col_name in DS_COLS[3:] if ds_tbl.column(col_name).null_count < ds_tbl.num_rows]
+
+    return csv_file, ds_tbl, ds_prop_list
+
+
 def make_datasets():
-    ''' Reads CSV files into pandas dataframes, extracting datasets
+    ''' Reads CSV files into pyarrow tables in parallel, extracting datasets
 
-    :returns: list of csv filenames, pandas dataframe containing datasets, dict of borehole_header_id -> col names
+    :returns: list of csv filenames, pyarrow table containing datasets, dict of borehole_header_id -> col names
 
-    pandas dataframe format:
+    pyarrow table format:
         First column: 'borehole_header_id' links with the bh dataset
         Second column: 'depth'
         Third and subsequent columns:  row[:11] = 'depth_point', 'diameter' etc.
     '''
     csv_file_list = []
-    # Open up output file
-    datasets = pd.DataFrame(columns=DS_COLS)
+    # Per-file pyarrow tables, concatenated once after reading
+    tables = []
     ds_property_dict  = {}
-    # Scan data directory for all CSV files and process them
-    for file_idx, csv_file in enumerate(glob.glob(os.path.join(DATA_DIR, "*.csv"))):
-        # Process a CSV file
-        print("Processing ", csv_file)
-        # Dataset property list
-        ds_prop_list = []
-        # Read csv file, header in 3rd row
-        src_ds = pd.read_csv(csv_file, header=3)
-        # If not in 3rd row, try the 4th
-        if src_ds.columns.str.match('Unnamed')[0]:
-            src_ds = pd.read_csv(csv_file, header=4)
-        if src_ds.columns.str.match('Unnamed')[0]:
-            print(f"Cannot find data header in {csv_file}")
-            sys.exit(1)
-        ds = pd.DataFrame(columns=DS_COLS)
-        for col_name, col in ds.items():
-            if col_name == 'borehole_header_id':
-                continue
-            # Looking to columns in input file - try one of two options else fail
-            if COL_MAP[col_name][0] in src_ds:
-                ds[col_name] = src_ds[COL_MAP[col_name][0]]
-            elif len(COL_MAP[col_name]) > 1 and COL_MAP[col_name][1] in src_ds:
-                ds[col_name] = src_ds[COL_MAP[col_name][1]]
-            else:
-                print(f"{COL_MAP[col_name]} is missing from {csv_file}")
-                print("src_ds=", list(src_ds))
-                sys.exit(1)
-                
-            # Only add to list if all columns are not "NaN"
-            if not ds[col_name].isna().values.all() and col_name not in ['depth', 'depth_point']:
-                ds_prop_list.append(col_name)
-
-        # First column: 'borehole_header_id' links with the bh dataset
-        # Second column: 'depth'
-        # Third and subsequent columns:  row[:11] = 'depth_point', 'diameter' etc.     
-        ds['borehole_header_id'] = file_idx + 1
-        datasets = pd.concat([datasets,ds])
+    # Scan data directory for all CSV files and process them, results are in the same order as the files
+    csv_files = glob.glob(os.path.join(DATA_DIR, "*.csv"))
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(read_dataset, range(len(csv_files)), csv_files, chunksize=4))
+    for file_idx, (csv_file, ds_tbl, ds_prop_list) in enumerate(results):
+        LOGGER.debug("Processed %s", csv_file)
+        tables.append(ds_tbl)
         ds_property_dict[str(file_idx + 1)] = ds_prop_list
         csv_file_list.append(csv_file)
 
+    # Each file's table becomes a chunk of the combined table, they all have the same column types
+    try:
+        datasets = pa.concat_tables(tables) if tables else DS_SCHEMA.empty_table()
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as ae:
+        print(f"Cannot combine datasets: {ae}")
+        sys.exit(1)
+    print(f"Read {len(datasets)} datasets from {len(csv_file_list)} CSV files")
+
     return csv_file_list, datasets, ds_property_dict
 
 
 def make_features(s3, csv_file_list):
-    ''' Extracts borehole feature data from CSV files and writes them to 'features.csv' file
+    ''' Extracts borehole feature data from CSV files
+    Zip files are uploaded to AWS S3 concurrently, the feature rows are returned in file order once all are done
 
+    :param s3: s3 client object returned from "boto3.client('s3')"
     :param csv_file_list: list of CSV files to process
+    :returns: list of feature rows, 'long' and 'lat' are floats
+
+    feature row format:
+        "identifier","borehole_id","name","boreholeMaterialCustodian","description","drillStartDate","drillEndDate","easting","northing","elevation_m","boreholeLength_m","long","lat",
+        "nvclCollection", "drillingMethod", "driller", "startPoint", "inclinationType", "elevation_srs", "operator", "datasetURL"
     '''
-    with open('features.txt', 'w', newline='') as csvfile:
-        # Write header
-        csvwriter = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
-        csvwriter.writerow(["identifier","borehole_id","name","boreholeMaterialCustodian","description","drillStartDate","drillEndDate","easting","northing","elevation_m","boreholeLength_m","long","lat"] + \
-                           ["nvclCollection", "drillingMethod", "driller", "startPoint", "inclinationType", "elevation_srs", "operator", "datasetURL"])
+    print(f"Processing {len(csv_file_list)} CSV files, uploading zip files to {BUCKET_NAME}")
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        # Maps upload future -> feature row, in file order
+        uploads = {}
         # Scan for all CSV files and process them
         for file_idx, csv_file in enumerate(csv_file_list):
 
-            # Write out ZIP file
-            zip_file = os.path.splitext(csv_file)[0] + '.zip'
-            print(f"Writing {zip_file}")
-            with ZipFile(zip_file, 'w') as myzip:
-                myzip.write(csv_file)
-                
-            # Upload zip file to AWS S3 Bucket
-            bucket_upload(s3, zip_file)
-            
-            print("Processing ", csv_file)
-            with open(csv_file) as csvfile:
-                csvreader = csv.reader(csvfile, delimiter=',')
-                for row_idx, row in enumerate(csvreader):
-                    # Read the metadata in the second row
-                    if row_idx == 1:
-                        # If borehole id is missing, assign one
-                        if row[11]=='':
-                            row[11] = row_idx + 100000
-                        csvwriter.writerow([file_idx + 1, row[11]] + row[:11] + ['false', 'unknown', 'unknown', 'natural ground surface', 'vertical', 'http://www.opengis.net/def/crs/EPSG/0/5711', 'unknown', BUCKET_DIR + os.path.basename(zip_file) ])
-    os.rename('features.txt', 'features.csv')
-
-
-
-def bucket_upload(s3, zip_file: str):
-    ''' Uploads a zip file to AWS s3
+            # Name of ZIP file in AWS S3 Bucket
+            zip_file = os.path.splitext(os.path.basename(csv_file))[0] + '.zip'
+
+            LOGGER.debug("Processing %s", csv_file)
+            feature_row = None
+            with open(csv_file, newline='') as datafile:
+                csvreader = csv.reader(datafile, delimiter=',')
+                # Read the metadata in the second row, the rest of the file is not needed
+                next(csvreader, None)
+                row = next(csvreader, None)
+            if row is not None:
+                # If borehole id is missing, assign one
+                if row[11]=='':
+                    row[11] = 100001
+                # Convert location to float once here, boreholes without a valid location are skipped
+                try:
+                    row[9], row[10] = float(row[9]), float(row[10])
+                    feature_row = [file_idx + 1, row[11]] + row[:11] + ['false', 'unknown', 'unknown', 'natural ground surface', 'vertical', 'http://www.opengis.net/def/crs/EPSG/0/5711', 'unknown', BUCKET_DIR + zip_file ]
+                except ValueError:
+                    LOGGER.debug("Invalid location in %s", csv_file)
+
+            # Zip and upload to AWS S3 Bucket, overlapping with the processing of the next file
+            uploads[executor.submit(bucket_upload, s3, csv_file, zip_file)] = feature_row
+
+        for future in as_completed(uploads):
+            # Re-raises any exit from a failed upload
+            future.result()
+    # Uploads complete in any order, return the rows in file order so the geopackage is the same for every run
+    return [feature_row for feature_row in uploads.values() if feature_row is not None]
+
+
+def bucket_upload(s3, csv_file: str, zip_file: str):
+    ''' Zips up a CSV file in memory and uploads it to AWS s3, no zip file is written to local filesystem
 
     :param s3: s3 client object returned from "boto3.client('s3')"
-    :param zip_file: full path in local filesystem of zip file
+    :param csv_file: full path in local filesystem of CSV file
+    :param zip_file: name of zip file in s3 bucket folder
     '''
-    print(f"Uploading {zip_file} to {BUCKET_NAME}")
+    LOGGER.debug("Uploading %s to %s", zip_file, BUCKET_NAME)
     try:
-        s3.upload_file(zip_file, BUCKET_NAME, os.path.join(BUCKET_FOLDER, os.path.basename(zip_file)) )
+        # Very large zip files spill over to a temporary file rather than being held in memory
+        with SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE) as zip_buf:
+            # Fastest DEFLATE level, CSV text still compresses well and zipping keeps up with the upload
+            with ZipFile(zip_buf, 'w', compression=ZIP_DEFLATED, compresslevel=1) as myzip:
+                myzip.write(csv_file, arcname=os.path.basename(csv_file))
+            zip_buf.seek(0)
+            s3.upload_fileobj(zip_buf, BUCKET_NAME, os.path.join(BUCKET_FOLDER, zip_file), Config=TRANSFER_CONFIG)
     except BotoCoreError as bce:
         print(f"BotoCoreError: {bce}")
         sys.exit(1)
@@ -164,126 +353,93 @@ def bucket_upload(s3, zip_file: str):
         sys.exit(1)
 
 
-def make_geopackage(datasets: pd.DataFrame, ds_property_dict: dict, filename: str):
+def make_gpkg_point(point_geom_hdr: bytes, x: float, y: float, _pack=WKB_POINT.pack) -> bytes:
+    ''' Makes a geopackage point geometry, same output as pygeopkg's 'point_to_gpkg_point' but in a single pack
+
+    :param point_geom_hdr: geometry header returned from 'make_gpkg_geom_header()'
+    :param x: x coord
+    :param y: y coord
+    :returns: geopackage point geometry blob
+    '''
+    return point_geom_hdr + _pack(1, 1, x, y)
+
+
+def insert_rows(filename: str, table_name: str, field_names: list, rows):
+    ''' Bulk inserts rows into a geopackage table using one prepared statement in a single transaction
+    NB: Journalling and syncing are turned off, the geopackage is not usable if this fails part way
+
+    :param filename: geopackage filename with path
+    :param table_name: name of table
+    :param field_names: list of field names, one for each value in a row
+    :param rows: list or iterable of rows to insert
+    '''
+    with closing(sqlite3.connect(filename, isolation_level=None)) as conn:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA locking_mode=EXCLUSIVE')
+        conn.execute('BEGIN')
+        conn.executemany(f"INSERT INTO {table_name} ({', '.join(field_names)}) VALUES ({', '.join('?' * len(field_names))})", rows)
+        conn.execute('COMMIT')
+
+
+def make_geopackage(datasets: pa.Table, ds_property_dict: dict, filename: str, feature_rows: list):
     ''' Creates a geopackage file with borehole datasets which can be imported into geoserver
-    Reads 'features.csv' to extract feature data.
-    Uses the pandas frame to extract the datasets.
+    Uses the feature rows to extract feature data.
+    Uses the pyarrow table to extract the datasets.
 
-    :param datasets: pandas DataFrame of datasets
+    :param datasets: pyarrow table of datasets
     :param ds_property_dict: dataset property dict
     :param filename: geopackage filename with path
+    :param feature_rows: list of feature rows returned from 'make_features()'
     '''
 
     print(f"Writing out {filename}")
     gpkg = GeoPackage.create(filename)
 
-    srs_wkt = (
-        'GEOGCS["WGS 84",'
-        'DATUM["WGS_1984",'
-            'SPHEROID["WGS 84",6378137,298.257223563,'
-                'AUTHORITY["EPSG","7030"]],'
-            'AUTHORITY["EPSG","6326"]],'
-        'PRIMEM["Greenwich",0,'
-            'AUTHORITY["EPSG","8901"]],'
-        'UNIT["degree",0.0174532925199433,'
-            'AUTHORITY["EPSG","9122"]],'
-        'AUTHORITY["EPSG","4326"]]')
-
-    srs = SRS('WGS84', 'EPSG', 4326, srs_wkt)
-
     # CREATE BOREHOLES TABLE
-    # "identifier", "borehole_id", "name","boreholeMaterialCustodian","description","drillStartDate","drillEndDate","easting","northing","elevation_m","boreholeLength_m","long","lat","nvclCollection","drillingMethod","driller","startPoint","inclinationType","elevation_srs","operator"
-    fields = (
-        Field('identifier', SQLFieldTypes.integer),  # Integer incremented from 1 matches with an id in the data
-        Field('borehole_id', SQLFieldTypes.integer),  # Borehole identifier. NB: this is not unique
-        Field('name', SQLFieldTypes.text),
-        Field('datasetProperties', SQLFieldTypes.text),
-        Field('boreholeMaterialCustodian', SQLFieldTypes.text),
-        Field('description', SQLFieldTypes.text),
-        Field('drillStartDate', SQLFieldTypes.text),
-        Field('drillEndDate', SQLFieldTypes.text),
-        Field('elevation_m', SQLFieldTypes.float),
-        Field('boreholeLength_m', SQLFieldTypes.float),
-        Field('long', SQLFieldTypes.float),
-        Field('lat', SQLFieldTypes.float),
-        Field('nvclCollection', SQLFieldTypes.text),
-        Field('drillingMethod', SQLFieldTypes.text),
-        Field('driller', SQLFieldTypes.text),
-        Field('startPoint', SQLFieldTypes.text),
-        Field('inclinationType', SQLFieldTypes.text),
-        Field('elevation_srs', SQLFieldTypes.text),
-        Field('operator', SQLFieldTypes.text),
-        Field('datasetURL', SQLFieldTypes.text)
-    )
-    fc = gpkg.create_feature_class('boreholes', srs, fields=fields, shape_type=GeometryType.point)
-    # Generate the geometry header once because it is always the same
-    point_geom_hdr = make_gpkg_geom_header(fc.srs.srs_id)
+    fc = gpkg.create_feature_class('boreholes', WGS84_SRS, fields=BOREHOLE_FIELDS, shape_type=GeometryType.point)
 
     rows = []
     bh_location = {}
-    # Read features file
-    with open('features.csv', 'r', newline='') as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=',')
-        for idx, row in enumerate(csvreader):
-            # Skip header
-            if idx == 0:
-                continue
-            print("Feature:", idx, row)
-            dataset_id, borehole_id, name, boreholeMaterialCustodian, description, drillStartDate, drillEndDate, easting, northing, elevation_m, boreholeLength_m, long, lat, nvclCollection, drillingMethod, driller, startPoint, inclinationType, elevation_srs, operator, datasetURL = row
-            datasetProperties = ','.join(ds_property_dict[dataset_id])
-            try:
-                wkb = point_to_gpkg_point(point_geom_hdr, float(long), float(lat))
-                bh_location[str(idx)] = (float(long), float(lat))
-                rows.append((wkb, dataset_id, borehole_id, name, datasetProperties, boreholeMaterialCustodian, description, drillStartDate, drillEndDate, elevation_m, boreholeLength_m, long, lat, nvclCollection, drillingMethod, driller, startPoint, inclinationType, elevation_srs, operator, datasetURL))
-            except ValueError:
-                continue
-    field_names = [SHAPE, "identifier","borehole_id", "name", "datasetProperties", "boreholeMaterialCustodian","description","drillStartDate","drillEndDate","elevation_m","boreholeLength_m","long","lat","nvclCollection","drillingMethod","driller","startPoint","inclinationType","elevation_srs","operator", "datasetURL"]
-    fc.insert_rows(field_names, rows)
-
-    # CREATE DATASETS TABLE  
-    fields = (
-        Field('borehole_header_id', SQLFieldTypes.integer), # this matches up with 'identifier'
-        Field('borehole_id', SQLFieldTypes.integer),
-        Field('depth', SQLFieldTypes.float),
-        Field('depth_point', SQLFieldTypes.text),
-        Field('diameter', SQLFieldTypes.text),
-        Field('p_wave_amplitude', SQLFieldTypes.text),
-        Field('p_wave_velocity', SQLFieldTypes.text),
-        Field('density', SQLFieldTypes.text),
-        Field('magnetic_susceptibility', SQLFieldTypes.text),
-        Field('impedance', SQLFieldTypes.text),
-        Field('natural_gamma', SQLFieldTypes.text),
-        Field('resistivity', SQLFieldTypes.text)
-        )
-
-    fc = gpkg.create_feature_class('datasets', srs, fields=fields, shape_type=GeometryType.point)
-    # Generate the geometry header once because it is always the same
-    point_geom_hdr = make_gpkg_geom_header(fc.srs.srs_id)
-
-    rows = []
-    # Read datasets file
-    for idx, row in datasets.iterrows():
-        borehole_header_id, depth, depth_point, diameter, p_wave_amplitude, p_wave_velocity, density, magnetic_susceptibility, impedance, natural_gamma, resistivity = row
-        # print(idx, row)
-        x = y = 0.0
-        if str(borehole_header_id) in bh_location:
-            x, y = bh_location[str(borehole_header_id)]
-        else:
+    # Read feature rows
+    for idx, row in enumerate(feature_rows, start=1):
+        LOGGER.debug("Feature: %d %s", idx, row)
+        dataset_id, borehole_id, name, boreholeMaterialCustodian, description, drillStartDate, drillEndDate, easting, northing, elevation_m, boreholeLength_m, long, lat, nvclCollection, drillingMethod, driller, startPoint, inclinationType, elevation_srs, operator, datasetURL = row
+        datasetProperties = ','.join(ds_property_dict[str(dataset_id)])
+        wkb = make_gpkg_point(POINT_GEOM_HDR, long, lat)
+        # Key on the identifier which links with the datasets
+        bh_location[str(dataset_id)] = (long, lat)
+        rows.append((wkb, dataset_id, borehole_id, name, datasetProperties, boreholeMaterialCustodian, description, drillStartDate, drillEndDate, elevation_m, boreholeLength_m, long, lat, nvclCollection, drillingMethod, driller, startPoint, inclinationType, elevation_srs, operator, datasetURL))
+    insert_rows(filename, fc.name, BOREHOLE_FIELD_NAMES, rows)
+
+    # CREATE DATASETS TABLE
+    fc = gpkg.create_feature_class('datasets', WGS84_SRS, fields=DATASET_FIELDS, shape_type=GeometryType.point)
+
+    # The location is the same for all of a borehole's datasets, so only make its geometry once
+    wkb_by_bhid = {bhid: make_gpkg_point(POINT_GEOM_HDR, x, y) for bhid, (x, y) in bh_location.items()}
+    # Python values for each column, straight from the table's columns, nulls become None
+    cols = [datasets.column(col_name).to_pylist() for col_name in DS_COLS]
+    for borehole_header_id in set(cols[0]):
+        if str(borehole_header_id) not in wkb_by_bhid:
             print("Cannot find borehole dataset location")
             print(f"bh_location={bh_location}")
             print(f"borehole_header_id={borehole_header_id}")
             sys.exit(0)
-        wkb = point_to_gpkg_point(point_geom_hdr, x, y)
-        rows.append((wkb, borehole_header_id, depth, depth_point, diameter, p_wave_amplitude, p_wave_velocity, density, magnetic_susceptibility, impedance, natural_gamma, resistivity))
-            
-    field_names = [SHAPE, "borehole_header_id","depth","depth_point","diameter","p_wave_amplitude","p_wave_velocity","density","magnetic_susceptibility","impedance","natural_gamma","resistivity"]
-    fc.insert_rows(field_names, rows)
+    wkb_col = [wkb_by_bhid[str(borehole_header_id)] for borehole_header_id in cols[0]]
+
+    # Rows are only made as sqlite consumes them
+    insert_rows(filename, fc.name, DATASET_FIELD_NAMES, zip(wkb_col, *cols))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generates a geopkg file file borehole datasets")
     parser.add_argument("filename", help="Package filename e.g. ./mscl12.gpkg")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print progress for each file and feature")
     args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    # Only this script's messages, not the debug output of boto3 etc.
+    if args.verbose:
+        LOGGER.setLevel(logging.DEBUG)
     if os.sep not in args.filename:
         print("Filename must have a path separator e.g. ./filename.gpkg")
         sys.exit(1)
@@ -294,7 +450,7 @@ if __name__ == "__main__":
 
     # Connect to AWS
     try:
-        s3 = boto3.client('s3')
+        s3 = boto3.client('s3', config=S3_CONFIG)
     except BotoCoreError as bce:
         print(f"BotoCoreError: {bce}")
         sys.exit(1)
@@ -306,9 +462,9 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # Make WFS features
-    make_features(s3, csv_file_list)
+    feature_rows = make_features(s3, csv_file_list)
 
     # Make a geopkg file
-    make_geopackage(datasets, ds_property_dict, args.filename)
+    make_geopackage(datasets, ds_property_dict, args.filename, feature_rows)
     print("Done.")
     